@@ -3,97 +3,212 @@
 import os
 import sys  
 import argparse
-import pandas as pd 
+import csv
+import datetime
 import re
 import pathlib
-import glob
 import logging
 logger = logging.getLogger()
 
+# Example format: 'artic-inrb-mpox/2500/v1.0.0'
+# This regex checks for a scheme name, followed by a slash, a version number with at least 3 digits, another slash, and a version identifier.
+_SCHEME_RE = re.compile(r'\S*/\d{3,}/v\d\.\d\.\d(-\S+)?')
+
+# Cell values treated as missing, matching the default na_values of pandas.read_csv/read_excel.
+_NA_VALUES = frozenset([
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null',
+])
+
+
+def _na_to_none(value):
+    """
+    Return None for missing cell values, otherwise the value unchanged.
+    """
+    if isinstance(value, str) and value in _NA_VALUES:
+        return None
+    return value
+
+def _format_date(value):
+    """
+    Return date and datetime cell values as ISO strings, dropping the time when it is midnight.
+    Other values are returned unchanged.
+    """
+    if isinstance(value, datetime.datetime):
+        if value.time() == datetime.time() and value.tzinfo is None:
+            return value.date().isoformat()
+        return value.isoformat(sep=' ')
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+
+def _records_from_dataframe(df):
+    """
+    Convert a pandas DataFrame into a list of dictionaries, with missing values as None, and its column names.
+    """
+    df = df.astype(object).where(df.notna(), None)
+    records = [{col: _format_date(value) for col, value in row.items()} for row in df.to_dict('records')]
+    return records, list(df.columns)
+
+def _add_column(columns, name):
+    """
+    Return the column names with name appended, unless it is already present.
+    """
+    return columns if name in columns else columns + [name]
+
+def _dedupe_columns(columns):
+    """
+    Rename duplicate column names the way pandas does, e.g. 'a', 'a' becomes 'a', 'a.1'.
+    """
+    counts = {}
+    result = []
+    for col in columns:
+        count = counts.get(col, 0)
+        while count > 0:
+            counts[col] = count + 1
+            col = f"{col}.{count}"
+            count = counts.get(col, 0)
+        result.append(col)
+        counts[col] = count + 1
+    return result
+
+def read_xlsx(metadata_file):
+    """
+    Read the first worksheet of an XLSX file by streaming rows with openpyxl in read-only mode.
+    Falls back to pandas.read_excel if openpyxl is not available.
+    Returns the rows as a list of dictionaries and the column names.
+    """
+    try:
+        import openpyxl
+    except ImportError:
+        import pandas as pd
+        return _records_from_dataframe(pd.read_excel(metadata_file))
+    workbook = openpyxl.load_workbook(metadata_file, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = list(next(rows, ()))
+        rows = [row for row in rows if any(value is not None for value in row)]
+    finally:
+        workbook.close()
+    # Read-only mode pads rows to the sheet's reported dimension, so drop unnamed columns without any values.
+    width = max([len(header)] + [len(row) for row in rows])
+    header += [None] * (width - len(header))
+    keep = [
+        i for i in range(width)
+        if header[i] is not None or any(i < len(row) and row[i] is not None for row in rows)
+    ]
+    columns = _dedupe_columns([header[i] if header[i] is not None else f"Unnamed: {i}" for i in keep])
+    records = [
+        {col: _format_date(_na_to_none(row[i])) if i < len(row) else None for col, i in zip(columns, keep)}
+        for row in rows
+    ]
+    return records, columns
 
 def load_metadata(metadata_file):
     """
     Load metadata from a CSV or XLS file.
-    This function should handle both formats and return a structured format (e.g., list of dictionaries).
+    Both formats are returned as a list of dictionaries, one per row, with missing values (see _NA_VALUES) as None,
+    together with the list of column names.
     """
     if metadata_file.endswith('.csv'):
-        with open(metadata_file, 'r') as f:
-            logger.info(f'Read CSV file.')
-            return pd.read_csv(f)
-    elif metadata_file.endswith('.xls') or metadata_file.endswith('.xlsx'):
-        with open(metadata_file, 'r') as f:
-            logger.info(f'Read XLS file.')
-            return pd.read_excel(f)
+        logger.info(f'Read CSV file.')
+        with open(metadata_file, newline='', encoding='utf-8-sig') as f:
+            reader = csv.DictReader(f)
+            metadata = []
+            for row in reader:
+                if None in row:
+                    raise ValueError(f"Metadata file has more fields than column names on line {reader.line_num}.")
+                metadata.append({key: _na_to_none(value) for key, value in row.items()})
+            return metadata, list(reader.fieldnames or [])
+    elif metadata_file.endswith('.xlsx'):
+        logger.info('Read XLSX file.')
+        return read_xlsx(metadata_file)
+    elif metadata_file.endswith('.xls'):
+        import pandas as pd
+        logger.info(f'Read XLS file.')
+        return _records_from_dataframe(pd.read_excel(metadata_file))
     else:
         raise ValueError("Unsupported metadata file format. Please use CSV or XLS/XLSX.")
     
-def check_metadata(metadata):
+def check_metadata(metadata, columns):
     """
     Check if the metadata contains the required columns: 'sample', 'barcode', and any additional sample information.
+    Returns the metadata and column names with the required columns renamed to 'sample' and 'barcode'.
     """
     required_columns = ['sample', 'barcode']
-    metadata_columns = metadata.columns.to_list()
+    lower_map = {}
+    for metadata_col in columns:
+        lower_map.setdefault(str(metadata_col).lower(), metadata_col)
     key_dict = {}
     for col in required_columns:
-        for metadata_col in metadata_columns:
-            if col == metadata_col.lower():
-                key_dict[metadata_col] = col
-                break
-            elif col+"s" == metadata_col.lower():
-                key_dict[metadata_col] = col
-                break
-            elif col+"_name" == metadata_col.lower():
-                key_dict[metadata_col] = col
+        # Prefer an exact match so that renaming never overwrites an existing column, e.g. 'Sample' and 'sample'.
+        if col in columns:
+            key_dict[col] = col
+            continue
+        for key in (col, col+"s", col+"_name"):
+            if key in lower_map:
+                key_dict[lower_map[key]] = col
                 break
     if len(key_dict) != len(required_columns): 
         raise ValueError(f"Metadata file is missing required columns: {', '.join([col for col in required_columns if col not in key_dict.values()])}")
     logger.info(f'Found required columns coded with the following keys {key_dict}".')
-    metadata.rename(columns=key_dict, inplace=True)
-        
-    if not metadata['barcode'].unique().size == metadata['barcode'].size:
+    for row in metadata:
+        for old, new in key_dict.items():
+            if old != new:
+                row[new] = row.pop(old, None)
+    columns = [key_dict.get(col, col) for col in columns]
+
+    barcodes = [row.get('barcode') for row in metadata]
+    if len(set(barcodes)) != len(barcodes):
         raise ValueError("Metadata contains duplicate barcodes. Each barcode must be unique.")
     
-    if not metadata['sample'].unique().size == metadata['sample'].size: 
+    samples = [row.get('sample') for row in metadata]
+    if len(set(samples)) != len(samples):
         raise ValueError("Metadata contains duplicate sample names. Each sample name must be unique.")
-    metadata_size = metadata.shape[0]
-    metadata.dropna(subset=['sample'], inplace=True)
-    if metadata.shape[0] < metadata_size:
-        logger.warning(f"Removed {metadata_size - metadata.shape[0]} entries with missing sample names from metadata.")
 
-    return True
+    return metadata, columns
 
 
-def add_fastq_path_to_metadata(metadata, run_dir, platform):
+def barcode_directory(run_dir, barcode):
+    """
+    Return the path of the barcode subdirectory in run_dir, or None if there is no such directory.
+    Only plain names containing 'arcode' (e.g. barcode01, Barcode01) are considered barcode directories,
+    so barcodes with path separators or '..' never resolve outside run_dir.
     """
-    Add the full path to the fastq files in the metadata DataFrame.
+    if 'arcode' not in barcode or os.path.basename(barcode) != barcode or barcode in ('.', '..'):
+        return None
+    if os.altsep is not None and os.altsep in barcode:
+        return None
+    path = os.path.join(run_dir, barcode)
+    return path if os.path.isdir(path) else None
+
+def add_fastq_path_to_metadata(metadata, columns, run_dir, platform):
+    """
+    Add the full path to the fastq files to each entry in metadata.
     This function assumes that the run_dir contains subdirectories named after barcodes.
     """
     if platform == 'nanopore':
-        run_dir = pathlib.Path(run_dir).resolve()
-        existing_paths = glob.glob(os.path.join(run_dir,"*arcode*"))
-        logger.debug(f'Found the following barcode directory paths in the run_dir: {existing_paths}".')
+        run_dir_str = os.fspath(pathlib.Path(run_dir).resolve())
 
-        for i,row in metadata.iterrows():
-            if 'fastq_directory' in row and row['fastq_directory'] is not None and row['fastq_directory'] in existing_paths:
+        for row in metadata:
+            fastq_directory = row.get('fastq_directory')
+            if fastq_directory is not None and barcode_directory(run_dir_str, os.path.basename(fastq_directory)) == fastq_directory:
                 continue
-            elif os.path.join(run_dir, row['barcode']) in existing_paths:
-                metadata.at[i, 'fastq_directory'] = os.path.join(run_dir, row['barcode'])
-            elif os.path.join(run_dir, row['barcode'].lower()) in existing_paths:
-                metadata.at[i, 'fastq_directory'] = os.path.join(run_dir, row['barcode'].lower())
+            barcode = row.get('barcode')
+            if barcode is None:
+                row['fastq_directory'] = None
             else:
-                metadata.at[i, 'fastq_directory'] = None
-            logger.debug(f"Identified fastq_directory {metadata.at[i,'fastq_directory']} for barcode {row['barcode']}.")
-
-        metadata_size = metadata.shape[0]
-        metadata.dropna(subset=['fastq_directory'], inplace=True)
-        if metadata.shape[0] < metadata_size:
-            logger.warning(f"Removed {metadata_size - metadata.shape[0]} entries with missing fastq_directory from metadata.")
+                barcode = str(barcode)
+                row['fastq_directory'] = barcode_directory(run_dir_str, barcode) or barcode_directory(run_dir_str, barcode.lower())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Identified fastq_directory for barcodes %s.', {row.get('barcode'): row['fastq_directory'] for row in metadata})
     else:
         raise ValueError(f"Unsupported platform '{platform}'. Only 'ont' is currently supported.")
     
-    return metadata
+    return metadata, _add_column(columns, 'fastq_directory')
 
-def add_amplicon_scheme_to_metadata(metadata, amplicon_scheme, custom_scheme_path=None):
+def add_amplicon_scheme_to_metadata(metadata, columns, amplicon_scheme, custom_scheme_path=None):
     """
     Check if the amplicon scheme is in the correct format.
     """
@@ -102,39 +217,43 @@ def add_amplicon_scheme_to_metadata(metadata, amplicon_scheme, custom_scheme_pat
         # Check if the custom scheme path exists
         if not os.path.exists(custom_scheme_path):
             raise ValueError(f"Custom amplicon scheme path '{custom_scheme_path}' does not exist.")
-        metadata['custom_scheme_path'] = metadata.apply(
-            lambda row: custom_scheme_path, axis=1
-        )
-        metadata['custom_scheme_name'] = metadata.apply(
-            lambda row: amplicon_scheme, axis=1
-        )
+        for row in metadata:
+            row['custom_scheme_path'] = custom_scheme_path
+            row['custom_scheme_name'] = amplicon_scheme
+        columns = _add_column(_add_column(columns, 'custom_scheme_path'), 'custom_scheme_name')
     else:    
-        # Example format: 'artic-inrb-mpox/2500/v1.0.0'
-        # This regex checks for a scheme name, followed by a slash, a version number with at least 3 digits, another slash, and a version identifier.
         logging.info(f'Checking primal scheme {amplicon_scheme} has correct name format.')
 
-        if not re.match(r'^\S*\/\d{3,}\/v\d\.\d\.\d(-\S+)?$', amplicon_scheme):
+        if not _SCHEME_RE.fullmatch(amplicon_scheme):
             raise ValueError("Amplicon scheme must be in the format 'scheme/version/identifier  (e.g., artic-inrb-mpox/2500/v1.0.0)'.")
-        metadata['scheme_name'] = metadata.apply(
-            lambda row: amplicon_scheme, axis=1
-        )    
-    return metadata
+        for row in metadata:
+            row['scheme_name'] = amplicon_scheme
+        columns = _add_column(columns, 'scheme_name')
+    return metadata, columns
 
-def add_platform_to_metadata(metadata, platform, amplicon_scheme):
+def add_platform_to_metadata(metadata, columns, platform, amplicon_scheme):
     """
-    Add the platform and amplicon scheme to each entry in metadata DataFrame.
+    Add the platform to each entry in metadata.
     """
-    metadata['platform'] = metadata.apply(
-            lambda row: platform, axis=1
-    )
+    for row in metadata:
+        row['platform'] = platform
     
-    return metadata
+    return metadata, _add_column(columns, 'platform')
 
-def save_metadata(metadata, output_file='sample_sheet.csv'):
+def save_metadata(metadata, columns, output_file='sample_sheet.csv'):
     logging.info(f'Saving metadata to {output_file}.')
-    with open(output_file, 'w') as f:
-        metadata = metadata[metadata['sample'].notna()]
-        metadata.to_csv(f, index=False)
+    missing_sample = sum(row.get('sample') is None for row in metadata)
+    missing_fastq = sum(row.get('sample') is not None and row['fastq_directory'] is None for row in metadata)
+    if missing_sample:
+        logger.warning(f"Removed {missing_sample} entries with missing sample names from metadata.")
+    if missing_fastq:
+        logger.warning(f"Removed {missing_fastq} entries with missing fastq_directory from metadata.")
+    if missing_sample or missing_fastq:
+        metadata = [row for row in metadata if row.get('sample') is not None and row['fastq_directory'] is not None]
+    with open(output_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(metadata)
 
 def main():
     
@@ -154,16 +273,16 @@ def main():
     logger.info(f'Using platform "{args.platform}".')
 
     # Load metadata
-    metadata = load_metadata(args.metadata)
-    check_metadata(metadata)
+    metadata, columns = load_metadata(args.metadata)
+    metadata, columns = check_metadata(metadata, columns)
 
-    metadata = add_fastq_path_to_metadata(metadata, args.run_dir, args.platform)
+    metadata, columns = add_fastq_path_to_metadata(metadata, columns, args.run_dir, args.platform)
 
-    metadata = add_amplicon_scheme_to_metadata(metadata, args.amplicon_scheme, args.custom_scheme_path)
+    metadata, columns = add_amplicon_scheme_to_metadata(metadata, columns, args.amplicon_scheme, args.custom_scheme_path)
 
-    metadata = add_platform_to_metadata(metadata, args.platform, args.amplicon_scheme)
+    metadata, columns = add_platform_to_metadata(metadata, columns, args.platform, args.amplicon_scheme)
 
-    save_metadata(metadata, "sample_config.csv")
+    save_metadata(metadata, columns, "sample_config.csv")
 
 
 if __name__ == "__main__":